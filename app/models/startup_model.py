@@ -1,7 +1,11 @@
-from pydantic import BaseModel
+import msgspec
+from fastapi import Form
+from pydantic import BaseModel, HttpUrl
 from typing import Optional
 
-class GradeWithDescription(BaseModel):
+# Response models are msgspec structs: they are built and encoded far faster than
+# Pydantic models and are only ever serialized, never validated from user input
+class GradeWithDescription(msgspec.Struct):
     value: Optional[float]
     description: str
 
@@ -12,6 +16,14 @@ class StartupBase(BaseModel):
 class StartupCreate(StartupBase):
     pass
 
+class StartupSubmission(StartupBase):
+    github_url: HttpUrl
+
+    @classmethod
+    def as_form(cls, name: str = Form(...), github_url: HttpUrl = Form(...)) -> "StartupSubmission":
+        # Lets the form fields be declared as one dependency instead of separate Form parameters
+        return cls(name=name, github_url=github_url)
+
 class StartupInDB(StartupBase):
     id: int
     github_grade: Optional[float] = None
@@ -21,7 +33,7 @@ class StartupInDB(StartupBase):
     class Config:
         orm_mode = True
 
-class StartupGradingResponse(BaseModel):
+class StartupGradingResponse(msgspec.Struct):
     id: int
     name: str
     github_url: str
@@ -1,29 +1,56 @@
-from fastapi import APIRouter, HTTPException, File, UploadFile, Form
+import os
+import aiofiles
+import msgspec
+from fastapi import APIRouter, Depends, HTTPException, File, UploadFile, Response
 from app.startup_class import Startup
-from app.models.startup_model import GradeWithDescription, StartupGradingResponse
+from app.models.startup_model import GradeWithDescription, StartupGradingResponse, StartupSubmission
 
 # Create a new router instance
 router = APIRouter()
 
+# Size of the chunks uploads are streamed to disk in
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# Built once and reused for every response
+_ENCODER = msgspec.json.Encoder()
+
+
+class MsgspecResponse(Response):
+    # Same idea as FastAPI's ORJSONResponse, for the msgspec structs orjson cannot encode
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return _ENCODER.encode(content)
+
+
+async def _save_upload(upload: UploadFile) -> str:
+    # Stream the upload to a temporary file so it is never held in memory in full
+    suffix = os.path.splitext(upload.filename or "")[1]
+    async with aiofiles.tempfile.NamedTemporaryFile('wb', suffix=suffix, delete=False) as temp_file:
+        while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+            await temp_file.write(chunk)
+        return temp_file.name
+
+
 # POST endpoint to submit a new startup for grading
-@router.post("/startups/submit", response_model=StartupGradingResponse)
+@router.post("/startups/submit", response_class=MsgspecResponse)
 async def submit_startup(
-    name: str = Form(...),
-    github_url: str = Form(...),
+    submission: StartupSubmission = Depends(StartupSubmission.as_form),
     presentation_video: UploadFile = File(...),
     presentation_pdf: UploadFile = File(...)
 ):
+    video_path = pdf_path = None
     try:
-        # Read the contents of the uploaded files
-        video_content = await presentation_video.read()
-        pdf_content = await presentation_pdf.read()
+        # Stream the uploaded files to disk
+        video_path = await _save_upload(presentation_video)
+        pdf_path = await _save_upload(presentation_pdf)
 
         # Create a new Startup instance with the submitted data
         startup_data = Startup(
-            name=name,
-            github_url=github_url,
-            presentation_video=video_content,
-            presentation_pdf=pdf_content
+            name=submission.name,
+            github_url=str(submission.github_url),
+            presentation_video_path=video_path,
+            presentation_pdf_path=pdf_path
         )
 
         # Grade the startup and save it to the database
@@ -31,25 +58,30 @@ async def submit_startup(
         
         # Prepare the response using our updated StartupGradingResponse model
         response = StartupGradingResponse(
-            id=graded_startup.data.id,
-            name=graded_startup.data.name,
-            github_url=graded_startup.data.github_url,
+            id=graded_startup.id,
+            name=graded_startup.name,
+            github_url=graded_startup.github_url,
             github_grade=GradeWithDescription(
-                value=graded_startup.data.github_grade,
-                description=graded_startup.get_github_grade_description()
+                value=graded_startup.github_grade,
+                description=graded_startup.descriptions["github"]
             ),
             presentation_grade=GradeWithDescription(
-                value=graded_startup.data.presentation_grade,
-                description=graded_startup.get_presentation_grade_description()
+                value=graded_startup.presentation_grade,
+                description=graded_startup.descriptions["presentation"]
             ),
             novelty_grade=GradeWithDescription(
-                value=graded_startup.data.novelty_grade,
-                description=graded_startup.get_novelty_grade_description()
+                value=graded_startup.novelty_grade,
+                description=graded_startup.descriptions["novelty"]
             )
         )
         
-        # Return the response to the client
-        return response
+        # Return the response instance directly so FastAPI skips jsonable_encoder
+        return MsgspecResponse(response)
     except Exception as e:
         # If any error occurs during the process, raise an HTTP exception
         raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        # Remove the temporary upload files
+        for path in (video_path, pdf_path):
+            if path:
+                os.remove(path)
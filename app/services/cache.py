@@ -0,0 +1,161 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import httpx
+from diskcache import Cache
+
+
+# Directory of the on-disk cache shared by all services (e.g., "~/.cache/jam")
+CACHE_DIR = os.path.expanduser(os.getenv('JAM_CACHE_DIR', '~/.cache/jam'))
+
+cache = Cache(CACHE_DIR)
+
+
+class CachedLLM:
+    """
+    Chat completions and embeddings cached on disk by their exact request.
+
+    Identical requests (same model, messages and options) are answered from the cache
+    instead of OpenAI, across evaluations and process restarts. Embeddings are cached
+    per text, so only texts that were never embedded before are sent.
+    """
+
+    def __init__(self, create_completion: Callable[..., Awaitable[Any]], create_embeddings: Callable[..., Awaitable[Any]]):
+        # The request functions, e.g. the rate-limited, retried wrappers in app.services.clients
+        self.create_completion = create_completion
+        self.create_embeddings = create_embeddings
+
+    async def complete(self, model: str, messages: List[Dict[str, str]],
+                       parse: Optional[Callable[[str], Any]] = None, **kwargs: Any) -> Any:
+        """
+        Return the completion for a chat request, calling OpenAI only on a cache miss.
+
+        A reply is only cached if the model finished on its own (not cut off by max_tokens)
+        and, when a parse callback is given, if the callback accepted it. A bad reply is
+        therefore asked for again next time instead of being replayed from the cache.
+
+        Args:
+            model (str): The OpenAI model name.
+            messages (List[Dict[str, str]]): The chat messages.
+            parse (Optional[Callable[[str], Any]]): Parses and validates the reply, raising if it is unusable.
+            **kwargs: Extra options passed to chat.completions.create.
+
+        Returns:
+            Any: The parsed reply, or the content of the first choice if no parse callback is given.
+        """
+        parse = parse or (lambda content: content)
+        key = self._key(model, messages, kwargs)
+        content = cache.get(key)
+        if content is not None:
+            return parse(content)
+
+        response = await self.create_completion(model=model, messages=messages, **kwargs)
+        choice = response.choices[0]
+        result = parse(choice.message.content)
+        if choice.finish_reason == 'stop':
+            cache.set(key, choice.message.content)
+        return result
+
+    async def embed(self, model: str, texts: List[str]) -> List[List[float]]:
+        """
+        Return one embedding per text, requesting the uncached ones in a single batch.
+
+        Args:
+            model (str): The OpenAI embedding model name.
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            List[List[float]]: The embeddings, in the same order as the texts.
+        """
+        keys = [f'embedding:{model}:' + hashlib.sha256(text.encode('utf-8')).hexdigest() for text in texts]
+        embeddings = [cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            response = await self.create_embeddings(model=model, input=[texts[i] for i in missing])
+            for item in response.data:
+                i = missing[item.index]
+                embeddings[i] = item.embedding
+                cache.set(keys[i], item.embedding)
+        return embeddings
+
+    def _key(self, model: str, messages: List[Dict[str, str]], options: Dict[str, Any]) -> str:
+        request = json.dumps({'model': model, 'messages': messages, 'options': options}, sort_keys=True)
+        return 'llm:' + hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+
+async def cached_get(client: httpx.AsyncClient, url: str, params: Optional[Dict[str, Any]] = None,
+                     headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+    """
+    Send a GET request conditionally, using the ETag of the last successful response.
+
+    GitHub answers an unchanged resource with 304 Not Modified, which carries no body and
+    does not count against the rate limit; the cached body is then returned as a 200.
+
+    Args:
+        client (httpx.AsyncClient): The client used to send the request.
+        url (str): The URL to request.
+        params (Optional[Dict[str, Any]]): The query parameters.
+        headers (Optional[Dict[str, str]]): The request headers.
+
+    Returns:
+        httpx.Response: The response, rebuilt from the cache when the server returned 304.
+    """
+    headers = dict(headers or {})
+    request = json.dumps({'url': url, 'params': params, 'accept': headers.get('Accept')}, sort_keys=True, default=str)
+    key = 'etag:' + hashlib.sha256(request.encode('utf-8')).hexdigest()
+    cached = cache.get(key)
+    if cached is not None:
+        headers['If-None-Match'] = cached['etag']
+
+    response = await client.get(url, params=params, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        return httpx.Response(
+            200,
+            headers={'Content-Type': cached['content_type'], 'ETag': cached['etag']},
+            content=cached['content'],
+            request=response.request
+        )
+    etag = response.headers.get('ETag')
+    if response.status_code == 200 and etag:
+        cache.set(key, {'etag': etag, 'content': response.content, 'content_type': response.headers.get('Content-Type', '')})
+    return response
+
+
+def content_cached(namespace: str, version: str) -> Callable:
+    """
+    Cache the results of an async function or method on disk, keyed by a hash of its arguments' content.
+
+    The key is a BLAKE2b digest of the namespace, the version and every argument (bytes as
+    they are, anything else as canonical JSON), so identical inputs are answered from the
+    cache. A method's self is not part of the key. Change the version whenever the prompt
+    or model behind the function changes.
+
+    Args:
+        namespace (str): A name for the cached function (e.g., "pitch").
+        version (str): The version of the prompt and model used by the function.
+
+    Returns:
+        Callable: The decorator.
+    """
+    def decorator(function: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+        is_method = next(iter(inspect.signature(function).parameters), None) == 'self'
+
+        @functools.wraps(function)
+        async def wrapper(*args: Any) -> Any:
+            digest = hashlib.blake2b(f'{namespace}:{version}'.encode('utf-8'), digest_size=32)
+            for arg in args[1:] if is_method else args:
+                data = arg if isinstance(arg, bytes) else json.dumps(arg, sort_keys=True).encode('utf-8')
+                # Length-prefix every argument so different splits of the same bytes differ
+                digest.update(len(data).to_bytes(8, 'big'))
+                digest.update(data)
+            key = f'{namespace}:' + digest.hexdigest()
+            result = cache.get(key)
+            if result is None:
+                result = await function(*args)
+                cache.set(key, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,87 @@
+import os
+import httpx
+from aiolimiter import AsyncLimiter
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+from dotenv import load_dotenv
+from app.services.cache import CachedLLM
+
+
+load_dotenv()
+
+# One OpenAI client for the whole process, so every service reuses the same connection pool.
+# Its own retries are disabled; retry_transient is the retry policy for every service.
+openai_client = AsyncOpenAI(
+    api_key=os.getenv('OPENAI_API_KEY'),
+    http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)),
+    max_retries=0
+)
+
+# Shared client for GitHub and web search requests
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20),
+    timeout=10
+)
+
+# OpenAI requests per minute across every grader running in this process, kept under the account's rate limit
+request_limiter = AsyncLimiter(max_rate=500, time_period=60)
+
+# Transient OpenAI and HTTP failures (rate limits, connection errors and timeouts, 5xx) are retried
+# with jittered exponential backoff; APIConnectionError also covers APITimeoutError
+retry_transient = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((
+        RateLimitError, APIConnectionError, InternalServerError,
+        httpx.HTTPStatusError, httpx.TransportError
+    )),
+    reraise=True
+)
+
+
+@retry_transient
+async def create_chat_completion(**request):
+    async with request_limiter:
+        return await openai_client.chat.completions.create(**request)
+
+
+@retry_transient
+async def create_embeddings(**request):
+    async with request_limiter:
+        return await openai_client.embeddings.create(**request)
+
+
+@retry_transient
+async def create_transcription(**request):
+    # The file must be bytes or a (name, bytes) tuple, so a retried upload sends it again in full
+    async with request_limiter:
+        return await openai_client.audio.transcriptions.create(**request)
+
+
+@retry_transient
+async def create_file(**request):
+    # As with transcriptions, the file must be in memory so a retried upload sends it again in full
+    async with request_limiter:
+        return await openai_client.files.create(**request)
+
+
+@retry_transient
+async def retrieve_file_content(file_id):
+    async with request_limiter:
+        return await openai_client.files.content(file_id)
+
+
+@retry_transient
+async def create_batch(**request):
+    async with request_limiter:
+        return await openai_client.batches.create(**request)
+
+
+@retry_transient
+async def retrieve_batch(batch_id):
+    async with request_limiter:
+        return await openai_client.batches.retrieve(batch_id)
+
+
+llm = CachedLLM(create_chat_completion, create_embeddings)
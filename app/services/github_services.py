@@ -1,27 +1,171 @@
 # Import necessary libraries
-import requests
-from github import Github
-from urllib.parse import urlparse, quote_plus
-import openai
+import asyncio
+from urllib.parse import urlparse, quote
 import os
 import json
-from typing import Dict, Tuple, List, Any
+import orjson
+import tiktoken
+from typing import Dict, Tuple, List, Any, Optional
 import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from app.services.cache import cached_get
+from app.services.clients import llm, http_client
+
+
+load_dotenv()
+
+# Repository validation and default branch head in one GraphQL request
+REPOSITORY_QUERY = """
+query($owner: String!, $name: String!) {
+  repository(owner: $owner, name: $name) {
+    defaultBranchRef {
+      target {
+        ... on Commit {
+          oid
+        }
+      }
+    }
+  }
+}
+"""
+
+# Static evaluation instructions, sent first so that OpenAI's prompt prefix cache can reuse them
+EVALUATION_INSTRUCTIONS = """
+You are a code and tech stack evaluation expert. Provide specific, detailed scores with one decimal place out of 100.
+
+You will be given a GitHub repository structure, its root files and the contents of its important files.
+Please provide the following evaluations:
+1. Repository Structure: Grade the overall structure out of 100 points. Be specific with the score (e.g., 87.6/100).
+2. Code Quality: Evaluate the code quality based on the provided file contents. Grade out of 100 points, being specific (e.g., 92.7/100).
+3. Security: Evaluate the code security. Grade out of 100 points, being specific (e.g., 88.3/100).
+4. Documentation: Evaluate the code documentation. Grade out of 100 points, being specific (e.g., 95.2/100).
+5. Efficiency: Evaluate the code efficiency. Grade out of 100 points, being specific (e.g., 91.8/100).
+6. Tech Stack: List up to 5 main technologies/frameworks likely used in this project, and grade from 0 to 100 how modern and appropriate the tech stack seems for the project. Be specific with the score (e.g., 87.6/100).
+
+For criteria 2-5, consider relevant factors and provide a brief explanation.
+
+Format your response as a JSON object with the following structure:
+{
+    "structure_grade": 0.0,
+    "code_quality": {"rating": 0.0, "explanation": ""},
+    "security": {"rating": 0.0, "explanation": ""},
+    "documentation": {"rating": 0.0, "explanation": ""},
+    "efficiency": {"rating": 0.0, "explanation": ""},
+    "tech_stack": {"stack": ["technology1", "technology2", ...], "grade": 0.0}
+}
+"""
+
+# Tokens of file content sent for evaluation, split evenly between the important files
+CODE_TOKEN_BUDGET = 6000
+
+@lru_cache(maxsize=1)
+def _get_encoding() -> tiktoken.Encoding:
+    # Loaded on first use, since building the encoding may download its vocabulary
+    return tiktoken.encoding_for_model("gpt-4o")
+
+def _truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Truncate a text to at most max_tokens tokens of the evaluation model.
+
+    Args:
+        text (str): The text to truncate.
+        max_tokens (int): The maximum number of tokens to keep.
+
+    Returns:
+        str: The text, or its first max_tokens tokens if it is longer.
+    """
+    tokens = _get_encoding().encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return _get_encoding().decode(tokens[:max_tokens])
+
+# Structured output schema of the evaluation, so every answer has the shape evaluate_repository reads
+EVALUATION_CRITERIA = ("code_quality", "security", "documentation", "efficiency")
+_CRITERION_SCHEMA = {
+    "type": "object",
+    "properties": {"rating": {"type": "number"}, "explanation": {"type": "string"}},
+    "required": ["rating", "explanation"],
+    "additionalProperties": False
+}
+EVALUATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "structure_grade": {"type": "number"},
+        **{criterion: _CRITERION_SCHEMA for criterion in EVALUATION_CRITERIA},
+        "tech_stack": {
+            "type": "object",
+            "properties": {"stack": {"type": "array", "items": {"type": "string"}}, "grade": {"type": "number"}},
+            "required": ["stack", "grade"],
+            "additionalProperties": False
+        }
+    },
+    "required": ["structure_grade", *EVALUATION_CRITERIA, "tech_stack"],
+    "additionalProperties": False
+}
+EVALUATION_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "repository_evaluation", "schema": EVALUATION_SCHEMA, "strict": True}
+}
+
+@lru_cache(maxsize=4096)
+def _parse_github_url_pure(url: str) -> Tuple[str, str]:
+    """
+    Parse a GitHub URL to extract the owner and repository name.
+    
+    Args:
+        url (str): The GitHub repository URL.
+    
+    Returns:
+        Tuple[str, str]: A tuple containing the owner and repository name.
+    
+    Raises:
+        ValueError: If the URL is not a valid GitHub repository URL.
+    """
+    parsed_url = urlparse(url)
+    
+    if parsed_url.netloc != 'github.com':
+        raise ValueError("Not a valid GitHub URL")
+    
+    path_components = parsed_url.path.strip('/').split('/')
+    
+    if len(path_components) < 2:
+        raise ValueError("URL does not contain a repository path")
+    
+    owner, repo = path_components[:2]
+    
+    return owner, repo
+
+@dataclass
+class RepoScan:
+    # The parts of a repository tree used by the evaluation, collected in one pass
+    structure: str
+    important_files: List[str]
+    root_files: List[str]
 
 class GithubCodeEvaluator:
+    # Evaluation results keyed by (owner, repo, commit SHA), shared across instances
+    _cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
+
+    # Files sent to OpenAI for the code evaluation
+    _IMPORTANT_NAMES = frozenset({'README.md', 'setup.py', 'requirements.txt'})
+    _IMPORTANT_EXTS = ('.py', '.js', '.ts')
+
     def __init__(self):
-        # Initialize GitHub client with token from environment variable
+        # GitHub API token from environment variable, sent with every GitHub request
         # GitHub API token for authentication (e.g., "ghp_1234567890abcdef")
-        self.github: Github = Github(os.getenv('GITHUB_TOKEN'))
-
-        # Set OpenAI API key from environment variable
-        # OpenAI API key for authentication (e.g., "sk-1234567890abcdef")
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+        github_token = os.getenv('GITHUB_TOKEN')
+        self.github_headers: Dict[str, str] = {'Authorization': f'Bearer {github_token}'} if github_token else {}
 
-    def evaluate_repository(self, repo_url: str) -> str:
+    async def evaluate_repository(self, repo_url: str) -> str:
         """
         Evaluate a GitHub repository for code quality and tech stack.
 
+        Results are cached per commit, so re-submitting an unchanged repository
+        skips all GitHub and OpenAI calls.
+
         Args:
             repo_url (str): The URL of the GitHub repository to evaluate.
 
@@ -33,6 +177,8 @@ class GithubCodeEvaluator:
                 - documentation_grade (float): The documentation grade (0-100).
                 - efficiency_grade (float): The efficiency grade (0-100).
                 - tech_stack_grade (float): The tech stack grade (0-100).
+                - overall_score (float): The mean of the code quality, security, documentation
+                    and efficiency grades (0-100).
                 - code_quality_explanation (str): Explanation of the code quality grade.
                 - security_explanation (str): Explanation of the security grade.
                 - documentation_explanation (str): Explanation of the documentation grade.
@@ -44,14 +190,15 @@ class GithubCodeEvaluator:
             ValueError: If the repository URL is invalid or the repository is not accessible.
         """
         owner, repo_name = self._parse_github_url(repo_url)
-        repo = self.github.get_repo(f"{owner}/{repo_name}")
-        
-        structure_analysis = self._analyze_repo_structure(repo)
-        important_files = self._get_important_files(repo)
-        code_content = self._fetch_important_content(repo, important_files)
+        sha = await self._fetch_head_sha(owner, repo_name)
+        cache_key = (owner, repo_name, sha)
+        if cache_key in self._cache:
+            return self._cache[cache_key]
         
-        code_evaluation = self._evaluate_code_with_openai(structure_analysis, code_content)
-        tech_stack = self._evaluate_tech_stack(repo)
+        evaluation = await self._evaluate_code(owner, repo_name, sha)
+        # A failed OpenAI evaluation is reported as zero scores but never cached
+        cacheable = evaluation is not None
+        code_evaluation, tech_stack = evaluation if cacheable else self._fallback_evaluation()
         
         summary = self._generate_summary(code_evaluation, tech_stack)
         
@@ -62,6 +209,7 @@ class GithubCodeEvaluator:
             "documentation_grade": code_evaluation['documentation']['rating'],
             "efficiency_grade": code_evaluation['efficiency']['rating'],
             "tech_stack_grade": tech_stack['grade'],
+            "overall_score": self._calculate_aggregate_grade(code_evaluation),
             "code_quality_explanation": code_evaluation['code_quality']['explanation'],
             "security_explanation": code_evaluation['security']['explanation'],
             "documentation_explanation": code_evaluation['documentation']['explanation'],
@@ -70,159 +218,215 @@ class GithubCodeEvaluator:
             "summary": summary
         }
         
-        return json.dumps(result, indent=2)
+        result_json = json.dumps(result, indent=2)
+        if cacheable:
+            self._cache[cache_key] = result_json
+        return result_json
 
     def _parse_github_url(self, url: str) -> Tuple[str, str]:
         """
         Parse a GitHub URL to extract the owner and repository name.
-        
+
+        Parsing is memoized; the repository itself is validated by _fetch_head_sha.
+        """
+        return _parse_github_url_pure(url)
+
+    async def _fetch_head_sha(self, owner: str, repo_name: str) -> str:
+        """
+        Fetch the default branch head commit with one GraphQL request.
+
+        GraphQL requires authentication, so without a GITHUB_TOKEN the head is read from
+        the REST commits endpoint instead, which works for public repositories.
+
         Args:
-            url (str): The GitHub repository URL.
-        
+            owner (str): The repository owner.
+            repo_name (str): The repository name.
+
         Returns:
-            Tuple[str, str]: A tuple containing the owner and repository name.
-        
+            str: The head commit SHA.
+
         Raises:
-            ValueError: If the URL is not a valid GitHub repository URL.
+            ValueError: If the repository is not found, not accessible or empty.
         """
-        parsed_url = urlparse(url)
-        
-        if parsed_url.netloc != 'github.com':
-            raise ValueError("Not a valid GitHub URL")
-        
-        path_components = parsed_url.path.strip('/').split('/')
-        
-        if len(path_components) < 2:
-            raise ValueError("URL does not contain a repository path")
-        
-        owner, repo = path_components[:2]
-        
-        try:
-            self.github.get_repo(f"{owner}/{repo}")
-        except Exception as e:
-            raise ValueError(f"Repository not found or not accessible: {str(e)}")
-        
-        return owner, repo
+        if 'Authorization' not in self.github_headers:
+            return await self._fetch_head_sha_rest(owner, repo_name)
 
-    def _analyze_repo_structure(self, repo) -> str:
-        structure = []
-        contents = repo.get_contents("")
-        for i, content in enumerate(contents):
-            if i >= 20:  # Limit to 20 items in the structure
-                structure.append("...(more files/directories)...")
-                break
-            if content.type == "dir":
-                structure.append(f"Directory: {content.path}")
-            else:
-                structure.append(f"File: {content.path}")
-        
-        has_tests = any("test" in item.lower() for item in structure)
-        return f"Repository structure:\n" + "\n".join(structure) + f"\n\nTests present: {'Yes' if has_tests else 'No'}"
+        response = await http_client.post(
+            "https://api.github.com/graphql",
+            json={"query": REPOSITORY_QUERY, "variables": {"owner": owner, "name": repo_name}},
+            headers=self.github_headers
+        )
+        if response.status_code != 200:
+            raise ValueError(f"Repository not found or not accessible: {response.status_code} {response.text}")
+
+        payload = orjson.loads(response.content)
+        repository = (payload.get('data') or {}).get('repository')
+        if repository is None:
+            errors = "; ".join(error['message'] for error in payload.get('errors', []))
+            raise ValueError(f"Repository not found or not accessible: {errors}")
+        if repository['defaultBranchRef'] is None:
+            raise ValueError("Repository has no commits")
+
+        return repository['defaultBranchRef']['target']['oid']
+
+    async def _fetch_head_sha_rest(self, owner: str, repo_name: str) -> str:
+        # The sha media type returns just the commit SHA of the default branch head as text
+        response = await http_client.get(
+            f"https://api.github.com/repos/{owner}/{repo_name}/commits/HEAD",
+            headers={'Accept': 'application/vnd.github.sha'}
+        )
+        if response.status_code == 409:
+            raise ValueError("Repository has no commits")
+        if response.status_code != 200:
+            raise ValueError(f"Repository not found or not accessible: {response.status_code} {response.text}")
+        return response.text.strip()
+
+    async def _evaluate_code(self, owner: str, repo_name: str, sha: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        tree = await self._fetch_tree(owner, repo_name, sha)
+        scan = self._scan_repo(tree)
+        code_content = await self._fetch_important_content(f"{owner}/{repo_name}", sha, scan.important_files)
+        return await self._evaluate_code_with_openai(scan, code_content)
+
+    async def _fetch_tree(self, owner: str, repo_name: str, sha: str) -> List[Dict[str, Any]]:
+        # A single recursive Git Trees request returns every path in the repository
+        response = await cached_get(
+            http_client,
+            f"https://api.github.com/repos/{owner}/{repo_name}/git/trees/{sha}",
+            params={'recursive': 1},
+            headers=self.github_headers
+        )
+        response.raise_for_status()
+        return orjson.loads(response.content)['tree']
+
+    def _scan_repo(self, tree: List[Dict[str, Any]]) -> RepoScan:
+        """
+        Collect everything the evaluation needs from the repository tree in a single pass.
 
-    def _get_important_files(self, repo) -> List[str]:
+        Args:
+            tree (List[Dict[str, Any]]): The entries of the recursive Git Trees response.
+
+        Returns:
+            RepoScan: The structure listing, the important files and the root files.
+        """
+        structure = []
+        has_tests = False
+        root_files = []
         important_files = []
-        contents = repo.get_contents("")
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                contents.extend(repo.get_contents(file_content.path))
-            elif file_content.name in ['README.md', 'setup.py', 'requirements.txt'] or file_content.name.endswith(('.py', '.js', '.ts')):
-                important_files.append(file_content.path)
-        return important_files[:5]  # Limit to 5 most important files
-
-    def _fetch_important_content(self, repo, important_files: List[str]) -> str:
-        content = ""
-        for file_path in important_files:
-            file_content = repo.get_contents(file_path)
-            file_text = file_content.decoded_content.decode('utf-8')
-            content += f"File: {file_path}\n\n{file_text}\n\n"
-        return content
-
-    def _evaluate_code_with_openai(self, structure_analysis: str, code_content: str) -> Dict[str, Any]:
-        prompt = f"""
-        Analyze the following GitHub repository structure and important file contents:
+        for entry in tree:
+            path = entry['path']
+            is_file = entry['type'] == "blob"
+            if '/' not in path:
+                if len(structure) < 20:  # Limit to 20 items in the structure
+                    structure.append(f"File: {path}" if is_file else f"Directory: {path}")
+                    has_tests = has_tests or "test" in path.lower()
+                elif len(structure) == 20:
+                    structure.append("...(more files/directories)...")
+                if is_file:
+                    root_files.append(path)
+            if is_file:
+                name = path.rsplit('/', 1)[-1]
+                if name in self._IMPORTANT_NAMES or name.endswith(self._IMPORTANT_EXTS):
+                    important_files.append(path)
 
-        Repository Structure:
-        {structure_analysis}
+        # Prefer shallower files, as the previous breadth-first walk did
+        important_files.sort(key=lambda path: path.count('/'))
+        structure_analysis = "Repository structure:\n" + "\n".join(structure) + f"\n\nTests present: {'Yes' if has_tests else 'No'}"
+        return RepoScan(
+            structure=structure_analysis,
+            important_files=important_files[:5],  # Limit to 5 most important files
+            root_files=root_files
+        )
 
-        Important File Contents:
-        {code_content}
+    async def _fetch_important_content(self, full_name: str, sha: str, important_files: List[str]) -> str:
+        # Download the raw files from the CDN concurrently instead of one base64 API response at a time
+        responses = await asyncio.gather(*[
+            http_client.get(f"https://raw.githubusercontent.com/{full_name}/{sha}/{quote(file_path)}", headers=self.github_headers)
+            for file_path in important_files
+        ])
 
-        Please provide the following evaluations:
-        1. Repository Structure: Grade the overall structure out of 100 points. Be specific with the score (e.g., 87.6/100).
-        2. Code Quality: Evaluate the code quality based on the provided file contents. Grade out of 100 points, being specific (e.g., 92.7/100).
-        3. Security: Evaluate the code security. Grade out of 100 points, being specific (e.g., 88.3/100).
-        4. Documentation: Evaluate the code documentation. Grade out of 100 points, being specific (e.g., 95.2/100).
-        5. Efficiency: Evaluate the code efficiency. Grade out of 100 points, being specific (e.g., 91.8/100).
+        # Truncate every file to its share of the token budget so large files cannot push
+        # the prompt past the model's context window
+        per_file_tokens = CODE_TOKEN_BUDGET // max(len(important_files), 1)
+        parts = []
+        for file_path, response in zip(important_files, responses):
+            response.raise_for_status()
+            parts.append(f"File: {file_path}\n\n{_truncate_tokens(response.text, per_file_tokens)}\n\n")
+        return "".join(parts)
 
-        For each criterion, consider relevant factors and provide a brief explanation.
+    async def _evaluate_code_with_openai(self, scan: RepoScan, code_content: str) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Evaluate the code and the tech stack with a single OpenAI request.
 
-        Format your response as a JSON object with the following structure:
-        {{
-            "structure_grade": 0.0,
-            "code_quality": {{"rating": 0.0, "explanation": ""}},
-            "security": {{"rating": 0.0, "explanation": ""}},
-            "documentation": {{"rating": 0.0, "explanation": ""}},
-            "efficiency": {{"rating": 0.0, "explanation": ""}}
-        }}
+        Args:
+            scan (RepoScan): The scanned repository tree.
+            code_content (str): The contents of the important files.
+
+        Returns:
+            Optional[Tuple[Dict[str, Any], Dict[str, Any]]]: The code evaluation and the tech stack
+                evaluation, or None if the OpenAI request failed.
+        """
+        # Only the repository-specific content goes in the user message, after the static instructions
+        prompt = f"""
+        Repository Structure:
+        {scan.structure}
+
+        Root Files:
+        {', '.join(scan.root_files)}
+
+        Important File Contents:
+        {code_content}
         """
 
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a code evaluation expert. Provide specific, detailed scores with one decimal place out of 100."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            return json.loads(response.choices[0].message['content'])
+            evaluation = await self._chat_completion([
+                {"role": "system", "content": EVALUATION_INSTRUCTIONS},
+                {"role": "user", "content": prompt}
+            ])
+            tech_stack = evaluation.pop('tech_stack')
+            return evaluation, tech_stack
         except Exception as e:
             logging.error(f"Error in OpenAI API request: {str(e)}")
-            return {
-                "structure_grade": 0.0,
-                "code_quality": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
-                "security": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
-                "documentation": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
-                "efficiency": {"rating": 0.0, "explanation": "Error occurred during evaluation"}
-            }
-
-    def _evaluate_tech_stack(self, repo) -> Dict[str, Any]:
-        files = repo.get_contents("")
-        file_list = [file.path for file in files if file.type == "file"]
-        
-        prompt = f"""
-        Based on the following list of files in a GitHub repository, identify the likely tech stack used:
-
-        {', '.join(file_list)}
+            return None
 
-        Please provide:
-        1. A list of up to 5 main technologies/frameworks likely used in this project.
-        2. A grade from 0 to 100 evaluating how modern and appropriate the tech stack seems for the project. Be specific with the score (e.g., 87.6/100).
+    def _fallback_evaluation(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # Zero scores reported when the OpenAI evaluation failed
+        return {
+            "structure_grade": 0.0,
+            "code_quality": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
+            "security": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
+            "documentation": {"rating": 0.0, "explanation": "Error occurred during evaluation"},
+            "efficiency": {"rating": 0.0, "explanation": "Error occurred during evaluation"}
+        }, {"stack": [], "grade": 0.0}
 
-        Format your response as a JSON object with the following structure:
-        {{
-            "stack": ["technology1", "technology2", ...],
-            "grade": 0.0
-        }}
-        """
+    async def _chat_completion(self, messages: List[Dict[str, str]]) -> Dict[str, Any]:
+        # Rate limiting and retries of transient errors happen inside llm
+        return await llm.complete(
+            "gpt-4o", messages, parse=self._parse_evaluation, response_format=EVALUATION_RESPONSE_FORMAT, max_tokens=1000
+        )
 
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a tech stack evaluation expert. Provide specific, detailed scores with one decimal place out of 100."},
-                    {"role": "user", "content": prompt}
-                ]
+    @staticmethod
+    def _parse_evaluation(response_text: str) -> Dict[str, Any]:
+        # Rejecting incomplete answers here also keeps them out of the completion cache
+        # The schema already enforces this shape; the check guards against answers that bypass it
+        evaluation = orjson.loads(response_text)
+        number = (int, float)
+        criteria = [evaluation.get(criterion) for criterion in EVALUATION_CRITERIA]
+        tech_stack = evaluation.get('tech_stack')
+        valid = (
+            isinstance(evaluation.get('structure_grade'), number)
+            and all(
+                isinstance(criterion, dict)
+                and isinstance(criterion.get('rating'), number)
+                and isinstance(criterion.get('explanation'), str)
+                for criterion in criteria
             )
-            # Extract only the JSON part from the response
-            response_text = response.choices[0].message['content']
-            json_start = response_text.find('{')
-            json_end = response_text.rfind('}') + 1
-            json_response = response_text[json_start:json_end]
-            return json.loads(json_response)
-        except Exception as e:
-            logging.error(f"Error in OpenAI API request for tech stack evaluation: {str(e)}")
-            return {"stack": [], "grade": 0.0}
+            and isinstance(tech_stack, dict)
+            and isinstance(tech_stack.get('grade'), number)
+            and isinstance(tech_stack.get('stack'), list)
+        )
+        if not valid:
+            raise ValueError("Evaluation does not match the expected shape")
+        return evaluation
 
     def _calculate_aggregate_grade(self, evaluation: Dict[str, Any]) -> float:
         """
@@ -258,6 +462,6 @@ class GithubCodeEvaluator:
 
 # Usage example:
 # evaluator = GithubCodeEvaluator()
-# result = evaluator.evaluate_repository("https://github.com/owner/repo")
+# result = asyncio.run(evaluator.evaluate_repository("https://github.com/owner/repo"))
 # print(f"Code Quality Grade: {result['code_quality_grade']}")
 # print(f"Summary: {result['summary']}")
\ No newline at end of file
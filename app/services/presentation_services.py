@@ -1,183 +1,359 @@
-from pdf2image import convert_from_bytes
+import asyncio
+from pdf2image import convert_from_path
 from PIL import Image
 import io
-import speech_recognition as sr
 import base64
 import os
-from openai import OpenAI
-from dotenv import load_dotenv
+from collections import Counter
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 import json
-from pydub import AudioSegment
+import logging
+from app.services.cache import content_cached
+from app.services.clients import (
+    create_chat_completion, create_file, retrieve_file_content, create_batch, retrieve_batch
+)
+from app.services.transcription import transcribe_recording
 
 
-load_dotenv()
+# Version of the grading prompts and models; bump it to invalidate the cached grades
+PROMPT_VERSION = "4"
 
-client = OpenAI(api_key=os.getenv('APIKEY'))
+# Upper bounds on the length of the JSON answers, so a runaway generation cannot hold up grading
+SLIDE_MAX_TOKENS = 300
+PITCH_MAX_TOKENS = 1000
 
-class PresentationEvaluator:
+# Maximum number of slides graded at once, to stay within the OpenAI rate limits
+SLIDE_CONCURRENCY = 8
+
+# Resolution slides are rendered at; about 85 DPI scaled by 0.3, so no resize is needed afterwards
+SLIDE_DPI = 26
+
+# Structured output schema of the pitch evaluation; each criterion is scored from 0 to 10
+_CRITERION_SCHEMA = {
+    "type": "object",
+    "properties": {"score": {"type": "number"}, "explanation": {"type": "string"}},
+    "required": ["score", "explanation"],
+    "additionalProperties": False
+}
+PITCH_CRITERIA = [
+    "clarity_of_message",
+    "value_proposition",
+    "structure_and_flow",
+    "engagement_and_persuasiveness",
+    "relevance_to_tech_industry",
+    "scalability_and_growth_potential"
+]
+PITCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **{criterion: _CRITERION_SCHEMA for criterion in PITCH_CRITERIA},
+        "overall_score": {"type": "number"},
+        "summary": {"type": "string"}
+    },
+    "required": PITCH_CRITERIA + ["overall_score", "summary"],
+    "additionalProperties": False
+}
+
+PITCH_PROMPT = """Evaluate the following startup pitch transcription based on these criteria:
+
+1. Clarity of Message
+   - Is the business idea clearly articulated?
+   - Are the problem statement and solution easy to understand?
+
+2. Value Proposition
+   - Does the speech emphasize what makes the solution unique?
+   - Is the value to customers or users clearly explained?
+
+3. Structure and Flow
+   - Is the speech logically organized with a clear beginning, middle, and end?
+   - Are the transitions between points smooth?
+
+4. Engagement and Persuasiveness
+   - Does the language capture attention and maintain interest?
+   - Is the content delivered in an engaging tone, making a strong case for the solution?
+
+5. Relevance to Tech Industry
+   - Does the pitch address a problem or opportunity that aligns with current tech trends?
+   - Does it mention how the solution leverages technology or meets tech industry needs?
+
+6. Scalability and Growth Potential
+   - Does the pitch highlight the potential for scaling the solution?
+   - Are there references to market size or growth opportunities?
+
+Provide a score from 0 to 10 for each criterion and a brief explanation, an overall score and a short summary.
+
+Transcription:"""
+
+PITCH_SYSTEM_MESSAGE = {"role": "system", "content": PITCH_PROMPT}
+PITCH_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "pitch_evaluation", "schema": PITCH_SCHEMA, "strict": True}
+}
+
+# Seconds between status checks of a submitted Batch API job
+BATCH_POLL_INTERVAL = 30
+
+SLIDE_PROMPT = """Grade this presentation slide from 0.0 to 100.0 (be specific, e.g. 87.3) on:
+- Simplicity: clear, concise, one main idea
+- Color and typography: readable, consistent fonts; good contrast
+- Structure and whitespace: uncluttered
+- Graphics and icons: visuals support the message
+- Professionalism: polished look, mature vocabulary
+- Overall impression
+List up to three short main issues."""
 
-    def __init__(self):
-        self.client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+SLIDE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "number"},
+        "main_issues": {"type": "array", "items": {"type": "string"}}
+    },
+    "required": ["score", "main_issues"],
+    "additionalProperties": False
+}
 
-    def process_presentation(self, pdf_content: bytes, audio_bytes: bytes, dpi: int = 85, resize_factor: float = 0.4) -> str:
-        # Process PDF slides
-        images = self._convert_pdf_to_images(pdf_content, dpi, resize_factor)
-        slides_feedback = self._grade_pdf_images(images)
-        
-        # Process audio pitch
-        transcription = self._transcribe_audio(audio_bytes)
-        pitch_evaluation = self._evaluate_pitch(transcription)
+# The system message and response format are identical for every slide, so they are built once
+SLIDE_SYSTEM_MESSAGE = {"role": "system", "content": SLIDE_PROMPT}
+SLIDE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "slide_evaluation", "schema": SLIDE_SCHEMA, "strict": True}
+}
+
+class PresentationEvaluator:
+
+    async def process_presentation(self, pdf_path: str, audio_path: str, dpi: int = SLIDE_DPI) -> str:
+        # The slides and the pitch are graded independently, so both pipelines run concurrently
+        slides_feedback, pitch_evaluation = await asyncio.gather(
+            self._slides_pipeline(pdf_path, dpi),
+            self._pitch_pipeline(audio_path)
+        )
 
         # Combine results
         combined_result = {
-            "slides_evaluation": json.loads(slides_feedback),
+            "slides_evaluation": slides_feedback,
             "pitch_evaluation": pitch_evaluation
         }
 
         return json.dumps(combined_result)
     
-    def _convert_pdf_to_images(self, pdf_content: bytes, dpi: int = 85, resize_factor: float =0.4) -> list[str]:
-        # Function skeleton
-        # Convert PDF pages to images with a lower DPI
-        pages = convert_from_bytes(pdf_content, dpi=dpi)
-        base64_images = []
-
-        for page in pages:
-            # Resize the image using the resize_factor
-            width, height = page.size
-            new_size = (int(width * resize_factor), int(height * resize_factor))
-            resized_page = page.resize(new_size, Image.LANCZOS)
-
-            # Convert the page to a bytes object
-            image_bytes = io.BytesIO()
-            resized_page.save(image_bytes, format='PNG')
-
-            # Base64 encode the image bytes
-            image_base64 = base64.b64encode(image_bytes.getvalue()).decode('utf-8')
-            base64_images.append(image_base64)
-
-        return base64_images
-
-    def _grade_pdf_images(self, images: list[str]) -> str:
-        PROMPT = """
-        You are provided with a series of images representing the slides of a presentation. 
-        Based on the following criteria:
-        - Simplicity: Are the slides clear, concise, and focused on one main idea per slide?
-        - Color and Typography: Are the font sizes readable, consistent, and do the colors maintain good contrast?
-        - Structure and Whitespace: Is there sufficient whitespace to avoid clutter?
-        - Graphics and Icons: Are images, charts, and icons used effectively to support the message?
-        - Overall Impression: What is your overall impression of the presentation?
-        - Proffesionalism: How professional does the presentation look and is the vocabulary used mature?
-        Evaluate the presentation as a whole and provide an overall score from 0.0 to 100.0. Be specific eg. 87.3.
-        Let the result be limited to just the score and three bullet points summarizing the main issues formatted in JSON with the schema 
-        {
-            "score": float,  // Overall score from 0.0 to 100.0
-            "main_issues": [
-                string,  // First main issue
-                string,   // Second main issue
-                string // Third main issue
-            ]
-        }
-        Ensure that your response can be parsed as valid JSON.
+    async def grade_many(self, presentations: list[tuple[str, str]], dpi: int = SLIDE_DPI) -> list[str]:
         """
-        # Prepare messages with the prompt and images
-        messages = [
-            {"role": "system", "content": PROMPT}
-        ]
+        Grade many presentations at once through the OpenAI Batch API, for non-interactive runs
+        (e.g., a whole hackathon). Batch requests cost half as much and do not count against the
+        realtime rate limits, but may take up to 24 hours to complete.
 
-        # Add each image as a separate message
-        for image_base64 in images:
-            image_message = {
-                "role": "user",
-                "content": f"![slide](data:image/png;base64,{image_base64})"
-            }
-            messages.append(image_message)
-
-        # Call OpenAI's GPT-4 API
-        response = client.chat.completions.create(model="gpt-4o",  # use 'gpt-4-vision' for models that support images
-        messages=messages)
-
-        # Get the response text
-        feedback = response.choices[0].message.content
-        return feedback
-    
-    def _transcribe_audio(self, audio_bytes: bytes) -> str:
-        # Convert MP3 bytes to WAV
-        audio = AudioSegment.from_mp3(io.BytesIO(audio_bytes))
-        wav_io = io.BytesIO()
-        audio.export(wav_io, format="wav")
-        wav_io.seek(0)
-
-        # Transcribe WAV
-        recognizer = sr.Recognizer()
-        with sr.AudioFile(wav_io) as source:
-            audio_data = recognizer.record(source)
-            try:
-                text = recognizer.recognize_google(audio_data)
-                return text
-            except sr.UnknownValueError:
-                return "Speech recognition could not understand the audio"
-            except sr.RequestError as e:
-                return f"Could not request results from speech recognition service; {e}"
-    
-    def _evaluate_pitch(self, transcription: str) -> dict:
-        prompt = """
-        Evaluate the following startup pitch transcription based on these criteria:
-
-        1. Clarity of Message
-           - Is the business idea clearly articulated?
-           - Are the problem statement and solution easy to understand?
-
-        2. Value Proposition
-           - Does the speech emphasize what makes the solution unique?
-           - Is the value to customers or users clearly explained?
-
-        3. Structure and Flow
-           - Is the speech logically organized with a clear beginning, middle, and end?
-           - Are the transitions between points smooth?
-
-        4. Engagement and Persuasiveness
-           - Does the language capture attention and maintain interest?
-           - Is the content delivered in an engaging tone, making a strong case for the solution?
-
-        5. Relevance to Tech Industry
-           - Does the pitch address a problem or opportunity that aligns with current tech trends?
-           - Does it mention how the solution leverages technology or meets tech industry needs?
-
-        6. Scalability and Growth Potential
-           - Does the pitch highlight the potential for scaling the solution?
-           - Are there references to market size or growth opportunities?
-
-        Provide a score from 0 to 10 for each criterion and a brief explanation. Format your response as a JSON object with the following structure:
-
-        {
-            "clarity_of_message": {"score": float, "explanation": string},
-            "value_proposition": {"score": float, "explanation": string},
-            "structure_and_flow": {"score": float, "explanation": string},
-            "engagement_and_persuasiveness": {"score": float, "explanation": string},
-            "relevance_to_tech_industry": {"score": float, "explanation": string},
-            "scalability_and_growth_potential": {"score": float, "explanation": string},
-            "overall_score": float,
-            "summary": string
-        }
+        Args:
+            presentations (list[tuple[str, str]]): (PDF path, audio path) pairs, one per presentation.
+            dpi (int): The resolution the slides are rendered at.
 
-        Transcription:
+        Returns:
+            list[str]: One JSON result per presentation, in the same shape as process_presentation.
         """
+        # Rendering and transcription run concurrently; only the gradings go through the batch
+        decks, transcriptions = await asyncio.gather(
+            asyncio.gather(*[asyncio.to_thread(self._convert_pdf_to_images, pdf_path, dpi) for pdf_path, _ in presentations]),
+            asyncio.gather(*[transcribe_recording(audio_path) for _, audio_path in presentations])
+        )
+
+        requests = {}
+        for i, (images, transcription) in enumerate(zip(decks, transcriptions)):
+            for j, image_base64 in enumerate(images):
+                requests[f"slide-{i}-{j}"] = self._slide_request(image_base64)
+            requests[f"pitch-{i}"] = self._pitch_request(transcription)
+        results = await self._run_batch(requests)
+
+        missing_pitches = [f"pitch-{i}" for i in range(len(presentations)) if f"pitch-{i}" not in results]
+        if missing_pitches:
+            raise RuntimeError(f"Could not grade {len(missing_pitches)} pitches: {', '.join(missing_pitches[:10])}")
 
-        response = self.client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": transcription}
-            ]
+        # As in _grade_pdf_images, a slide that could not be graded is left out of its deck's score
+        return [
+            json.dumps({
+                "slides_evaluation": self._aggregate_slides(
+                    [results[f"slide-{i}-{j}"] for j in range(len(images)) if f"slide-{i}-{j}" in results]
+                ),
+                "pitch_evaluation": results[f"pitch-{i}"]
+            })
+            for i, images in enumerate(decks)
+        ]
+
+    async def _run_batch(self, requests: dict[str, dict]) -> dict[str, dict]:
+        """
+        Submit chat completion requests as one Batch API job and wait for their JSON answers.
+        Requests the job did not answer are sent again through the realtime API.
+
+        Args:
+            requests (dict[str, dict]): The request bodies keyed by custom ID.
+
+        Returns:
+            dict[str, dict]: The parsed JSON answers keyed by custom ID. Requests that failed
+                in both the batch and the realtime API are left out.
+
+        Raises:
+            RuntimeError: If the job fails or is cancelled.
+        """
+        lines = [
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+            for custom_id, body in requests.items()
+        ]
+        input_file = await create_file(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await create_batch(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
         )
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            batch = await retrieve_batch(batch.id)
+        # An expired job still returns the answers it finished
+        if batch.status not in ("completed", "expired"):
+            raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+        results = {}
+        if batch.output_file_id is not None:
+            output = await retrieve_file_content(batch.output_file_id)
+            for line in output.text.splitlines():
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                choice = response["body"]["choices"][0]
+                if choice["finish_reason"] != "stop":
+                    continue
+                try:
+                    results[item["custom_id"]] = json.loads(choice["message"]["content"])
+                except ValueError:
+                    continue
+
+        missing = [custom_id for custom_id in requests if custom_id not in results]
+        if missing:
+            logging.error(f"Batch {batch.id} did not answer {len(missing)} requests, sending them again")
+            retried = await asyncio.gather(
+                *[self._chat(**requests[custom_id]) for custom_id in missing],
+                return_exceptions=True
+            )
+            for custom_id, content in zip(missing, retried):
+                if isinstance(content, BaseException):
+                    logging.error(f"Error in request {custom_id}: {str(content)}")
+                    continue
+                try:
+                    results[custom_id] = json.loads(content)
+                except ValueError as e:
+                    logging.error(f"Error in request {custom_id}: {str(e)}")
+        return results
+
+    async def _slides_pipeline(self, pdf_path: str, dpi: int) -> dict:
+        # Rendering blocks, so it runs in a worker thread
+        images = await asyncio.to_thread(self._convert_pdf_to_images, pdf_path, dpi)
+        return await self._grade_pdf_images(images)
+
+    async def _pitch_pipeline(self, audio_path: str) -> dict:
+        transcription = await transcribe_recording(audio_path)
+        return await self._evaluate_pitch(transcription)
+
+    def _convert_pdf_to_images(self, pdf_path: str, dpi: int = SLIDE_DPI) -> list[str]:
+        # Render PDF pages directly at the final, low DPI (no downscaling afterwards),
+        # rendering pages on every core; Poppler reads the file itself
+        pages = convert_from_path(pdf_path, dpi=dpi, thread_count=os.cpu_count() or 1)
+
+        # Encoding releases the GIL, so pages are processed in parallel threads
+        with ThreadPoolExecutor() as pool:
+            return list(pool.map(self._encode_page, pages))
+
+    def _encode_page(self, page: Image.Image) -> str:
+        # Convert the page to a bytes object
+        image_bytes = io.BytesIO()
+        page.convert('RGB').save(image_bytes, format='JPEG', quality=85, optimize=True)
+
+        # Base64 encode the image bytes straight from the buffer, without copying them out first
+        return base64.b64encode(image_bytes.getbuffer()).decode('ascii')
+
+    async def _grade_pdf_images(self, images: list[str]) -> dict:
+        """
+        Grade every slide with its own GPT-4o mini request, sent concurrently, and combine the results.
 
-        evaluation = json.loads(response.choices[0].message.content)
+        Grades are cached per slide, so a slide that failed is graded again on the next call
+        instead of a partial deck score being cached.
+
+        Args:
+            images (list[str]): The base64-encoded JPEG images of the slides.
+
+        Returns:
+            dict: The mean slide score and the three most frequent issues, as
+                {"score": float, "main_issues": [string, ...]}.
+        """
+        semaphore = asyncio.Semaphore(SLIDE_CONCURRENCY)
+        slide_results = await asyncio.gather(*[self._grade_slide(image_base64, semaphore) for image_base64 in images])
+        # A slide that could not be graded is left out rather than failing the whole deck
+        return self._aggregate_slides([result for result in slide_results if result is not None])
+
+    def _aggregate_slides(self, slide_results: list[dict]) -> dict:
+        # The presentation score is the mean slide score; the main issues are those reported most often
+        if not slide_results:
+            return {"score": 0.0, "main_issues": []}
+
+        score = round(sum(result["score"] for result in slide_results) / len(slide_results), 1)
+        issues = Counter(issue for result in slide_results for issue in result.get("main_issues", []))
+        return {"score": score, "main_issues": [issue for issue, _ in issues.most_common(3)]}
+
+    async def _grade_slide(self, image_base64: str, semaphore: asyncio.Semaphore) -> Optional[dict]:
+        try:
+            async with semaphore:
+                return await self._evaluate_slide(image_base64)
+        except ValueError as e:
+            # Truncated or malformed answers (json.JSONDecodeError is a ValueError) drop only this slide
+            logging.error(f"Error grading slide: {str(e)}")
+            return None
+
+    @content_cached("slide", PROMPT_VERSION)
+    async def _evaluate_slide(self, image_base64: str) -> dict:
+        content = await self._chat(**self._slide_request(image_base64))
+        return json.loads(content)
+
+    def _slide_request(self, image_base64: str) -> dict:
+        # Slides are rendered well below 512x512, so low detail sees the whole image for a
+        # fixed, small number of image tokens
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [
+                SLIDE_SYSTEM_MESSAGE,
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_base64}", "detail": "low"}}
+                ]}
+            ],
+            "response_format": SLIDE_RESPONSE_FORMAT,
+            "max_tokens": SLIDE_MAX_TOKENS
+        }
+
+    async def _chat(self, **request) -> str:
+        # Rate limiting and retries of transient errors happen inside create_chat_completion
+        choice = (await create_chat_completion(**request)).choices[0]
+        if choice.finish_reason == "length":
+            # The answer was cut off at max_tokens and is not valid JSON; retry once with twice the room
+            request = {**request, "max_tokens": request["max_tokens"] * 2}
+            choice = (await create_chat_completion(**request)).choices[0]
+        if choice.finish_reason != "stop":
+            raise ValueError(f"Chat completion did not finish (finish_reason={choice.finish_reason})")
+        return choice.message.content
+    
+    @content_cached("pitch", PROMPT_VERSION)
+    async def _evaluate_pitch(self, transcription: str) -> dict:
+        content = await self._chat(**self._pitch_request(transcription))
+        evaluation = json.loads(content)
         return evaluation
 
-    def _process_audio(self, audio_bytes: bytes) -> str:
-        transcription = self._transcribe_audio(audio_bytes)
-        evaluation = self._evaluate_pitch(transcription)
+    def _pitch_request(self, transcription: str) -> dict:
+
+        return {
+            "model": "gpt-4o-mini",
+            "messages": [PITCH_SYSTEM_MESSAGE, {"role": "user", "content": transcription}],
+            "response_format": PITCH_RESPONSE_FORMAT,
+            "max_tokens": PITCH_MAX_TOKENS
+        }
+
+    async def _process_audio(self, audio_path: str) -> str:
+        evaluation = await self._pitch_pipeline(audio_path)
         return json.dumps(evaluation)
     
 
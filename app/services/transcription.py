@@ -0,0 +1,63 @@
+import asyncio
+from typing import Dict
+from app.services.cache import content_cached
+from app.services.clients import create_transcription
+
+
+# Transcriptions in progress, keyed by recording path, so evaluators grading the same upload
+# at the same time share one ffmpeg run and one Whisper request
+_pending: Dict[str, asyncio.Task] = {}
+
+
+async def transcribe_recording(path: str) -> str:
+    """
+    Transcribe the audio of a recording (MP3 or MP4) with OpenAI's Whisper API.
+
+    Args:
+        path (str): The path to the recording.
+
+    Returns:
+        str: The transcribed text.
+    """
+    task = _pending.get(path)
+    if task is None:
+        task = asyncio.ensure_future(_transcribe_recording(path))
+        _pending[path] = task
+        task.add_done_callback(lambda _: _pending.pop(path, None))
+    return await task
+
+
+async def _transcribe_recording(path: str) -> str:
+    # The downsampled audio is both the upload and the transcription cache key
+    audio_bytes = await extract_audio(path)
+    return await transcribe_audio(audio_bytes)
+
+
+async def extract_audio(path: str) -> bytes:
+    """
+    Extract the audio of a recording as 16 kHz mono MP3 data with an ffmpeg subprocess.
+
+    Whisper resamples everything to 16 kHz mono, so sending anything more only costs upload time.
+
+    Args:
+        path (str): The path to the recording.
+
+    Returns:
+        bytes: The MP3 audio data.
+    """
+    process = await asyncio.create_subprocess_exec(
+        'ffmpeg', '-loglevel', 'error', '-i', path, '-vn', '-ac', '1', '-ar', '16000',
+        '-acodec', 'libmp3lame', '-b:a', '32k', '-f', 'mp3', 'pipe:1',
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    audio_bytes, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed: {stderr.decode(errors="replace").strip()}')
+    return audio_bytes
+
+
+@content_cached('transcription', 'whisper-1')
+async def transcribe_audio(audio_bytes: bytes) -> str:
+    response = await create_transcription(model='whisper-1', file=('audio.mp3', audio_bytes))
+    return response.text
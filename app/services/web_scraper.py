@@ -1,41 +1,81 @@
-import requests
-import openai
+import asyncio
 import os
 import json
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from moviepy.editor import VideoFileClip
+import logging
+import time
+from functools import lru_cache
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
 from urllib.parse import urlparse
+from dotenv import load_dotenv
+from app.services.cache import cached_get
+from app.services.clients import llm, http_client, retry_transient
+from app.services.transcription import transcribe_recording
 
 
-class NoveltyEvaluator:
-    def __init__(self):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+load_dotenv()
+
+# Every prompt here only summarizes or compares summaries, which a small model handles as
+# well as GPT-4 at a fraction of the cost and latency
+SUMMARY_MODEL = 'gpt-4o-mini'
+
+# Maximum characters of each document sent in a batched summary request, so that
+# ten READMEs still fit in the model's context window
+MAX_BATCH_ITEM_CHARS = 2000
+
+# Status codes worth retrying, and how close to the GitHub rate limit a request may get
+# before waiting for the window to reset (waiting at most MAX_RATE_LIMIT_WAIT seconds)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_THRESHOLD = 1
+MAX_RATE_LIMIT_WAIT = 60
+
+# Stateless bag-of-words vectorizer for the similarity fallback: nothing is fitted per call,
+# and its L2-normalized rows give cosine similarities as dot products
+_VECTORIZER = HashingVectorizer(n_features=2 ** 18, alternate_sign=False, norm='l2')
+
+# Last seen GitHub rate limit per resource ('core', 'search'): (remaining, reset epoch seconds)
+_github_rate_limits = {}
+
+
+@lru_cache(maxsize=256)
+def _parse_owner_repo(repo_url):
+    # Pure and called for every README fetch, so parsed URLs are memoized
+    path_parts = urlparse(repo_url).path.strip('/').split('/')
+    if len(path_parts) < 2:
+        raise ValueError("Invalid GitHub repository URL format")
+    return path_parts[0], path_parts[1]
 
+
+class NoveltyEvaluator:
     # Audio = True if mp3 file, Audio = False if mp4 file (video file)
-    def evaluate_novelty(self, project_repo_url, audio, presentation_file_path):
+    async def evaluate_novelty(self, project_repo_url, audio, presentation_file_path):
 
-        presentation_summary = self._build_project_summary(presentation_file_path=presentation_file_path, audio=audio)
-        github_cosine_similarity, github_repo, gh_repo_summary, proj_readme_summary = self._get_github_cosine_similarity(presentation_summary, project_repo_url)
-        google_cosine_similarity, google_article, google_article_summary = self._get_google_cosine_similarity(presentation_summary)
+        presentation_summary = await self._build_project_summary(presentation_file_path=presentation_file_path, audio=audio)
+        # The GitHub and Google comparisons share no data, so run them concurrently
+        (github_cosine_similarity, github_repo, gh_repo_summary, proj_readme_summary), (google_cosine_similarity, google_article, google_article_summary) = await asyncio.gather(
+            self._get_github_cosine_similarity(presentation_summary, project_repo_url),
+            self._get_google_cosine_similarity(presentation_summary)
+        )
 
         github_score = round((1 - github_cosine_similarity) * 100.0, 1)
         google_score = round((1 - google_cosine_similarity) * 100.0, 1)
         overall_score = round((github_score + google_score) / 2, 1)
 
-        github_summary = f'This project is not similar to any other projects found on GitHub. This helped you score a {github_score} out of 100 for your GitHub novelty score.'
-        if github_score > 60:
-            github_summary = f'This project is similar to a project found on GitHub. '
-            github_summary += self._make_openai_request(
+        # The two explanations are independent, so they are requested concurrently
+        github_summary, google_summary = await asyncio.gather(
+            self._explain_similarity(
+                github_score,
+                f'This project is not similar to any other projects found on GitHub. This helped you score a {github_score} out of 100 for your GitHub novelty score.',
+                'This project is similar to a project found on GitHub. ',
                 f'Here is a summary of a users github README file for a project they worked on: {proj_readme_summary}. Here is a summary of a github repository project that was found online: {gh_repo_summary}. These summaries are similar. In a few sentences, explain why these projects are similar.'
-            )
-
-        google_summary = f'This project is not similar to any other articles found on Google. This helped you score a {google_score} out of 100 for your Google novelty score.'
-        if google_score > 60:
-            google_summary = f'This project is similar to an article found on Google. '
-            google_summary += self._make_openai_request(
+            ),
+            self._explain_similarity(
+                google_score,
+                f'This project is not similar to any other articles found on Google. This helped you score a {google_score} out of 100 for your Google novelty score.',
+                'This project is similar to an article found on Google. ',
                 f'Here is a summary of a google article about a topic: Title: {google_article_summary}. Here is a summary of a presentation of about a project: {presentation_summary}. In a few sentences, explain why the Google article is similar to the project.'
             )
+        )
 
         response_json = {
             'github_score': github_score,
@@ -52,56 +92,96 @@ class NoveltyEvaluator:
         return response_json
 
 
-    def _get_github_cosine_similarity(self, presentation_summary, project_repo_url):
-        not_keywords = False
-        iter = 0
-        keywords = ''
-        while not_keywords and iter < 10:
-            keywords = self._make_openai_request(f'Here is a summary of a presentation about a project, please provide a 5 word title or 5 key words of this presentation separated by spaces. Do not include anything else in your response. It should only be 5 words separated by spaces. {presentation_summary}')
-            not_keywords = True if len(keywords.split(' ')) == 5 else False
-            iter += 1
-        if iter == 10:
+    async def _explain_similarity(self, score, not_similar_summary, similar_prefix, prompt):
+        if score > 60:
+            return similar_prefix + await self._make_openai_request(prompt)
+        return not_similar_summary
+
+
+    async def _get_github_cosine_similarity(self, presentation_summary, project_repo_url):
+        # Stop at the first well-formed answer; each retry uses a new seed so it is
+        # neither a cache hit nor the same sample again
+        for attempt in range(10):
+            keywords = await self._make_openai_request(
+                f'Here is a summary of a presentation about a project, please provide a 5 word title or 5 key words of this presentation separated by spaces. {presentation_summary}',
+                system='Respond with exactly 5 words separated by single spaces and nothing else.',
+                max_tokens=15,
+                seed=attempt
+            )
+            if len(keywords.split()) == 5:
+                break
+        else:
             raise ValueError('Could not generate keywords in 10 attempts')
-        repo_readme = self._fetch_readme(project_repo_url)
-        project_readme_summary = self._make_openai_request(
-            f'Here is a project github repo README file: {repo_readme}. Please provide a summary of the project in a couple sentences.'
+        repos = await self._search_github_repos(keywords)
+
+        # Fetch the project README and every candidate README concurrently
+        repo_readme, *readmes = await asyncio.gather(
+            self._fetch_readme(project_repo_url),
+            *[self._fetch_readme(repo['html_url']) for repo in repos]
+        )
+        candidates = [(repo, readme) for repo, readme in zip(repos, readmes) if readme is not None]
+
+        # Summarize the project README and, in a single batched request, all candidate READMEs
+        project_readme_summary, readme_summaries = await asyncio.gather(
+            self._make_openai_request(
+                f'Here is a project github repo README file: {repo_readme}. Please provide a summary of the project in a couple sentences.'
+            ),
+            self._summarize_batch('project README files of github repos', [readme for _, readme in candidates])
         )
-        repos = self._search_github_repos(keywords)
-        max_cosine_similarity = 0
-        max_repo = None
-        max_repo_summary = ''
-        for repo in repos:
-            readme = self._fetch_readme(repo['url'])
-            if readme is not None:
-                readme_summary = self._make_openai_request(
-                    f'Here is a project README file of a github repo: {readme}. Please provide a summary of the project in a couple sentences.'
-                )
-                cosine_similarity = self._get_cosine_similarity(project_readme_summary, readme_summary)
-                if cosine_similarity > max_cosine_similarity:
-                    max_cosine_similarity = cosine_similarity
-                    max_repo = repo
-                    max_repo_summary = readme_summary
+
+        max_cosine_similarity, best = await self._get_max_cosine_similarity(project_readme_summary, readme_summaries)
+        max_repo = candidates[best][0] if best is not None else None
+        max_repo_summary = readme_summaries[best] if best is not None else ''
         return max_cosine_similarity, max_repo, max_repo_summary, project_readme_summary
     
 
-    def _get_google_cosine_similarity(self, presentation_summary):
-        results = self._fetch_google_results(presentation_summary)
+    async def _get_google_cosine_similarity(self, presentation_summary):
+        results = await self._fetch_google_results(presentation_summary)
         articles = self._extract_article_info(results)
-        max_cosine_similarity = 0
-        max_article = None
-        max_article_summary = ''
-        for article in articles:
-            article_summary = self._make_openai_request(
-                f'Here is an article about a topic: Title: {article['title']}. Snippet: {article['snippet']}. Description: {article['description']}. Please provide a summary of the topic in a couple sentences.'
-            )
-            cosine_similarity = self._get_cosine_similarity(presentation_summary, article_summary)
-            if cosine_similarity > max_cosine_similarity:
-                max_cosine_similarity = cosine_similarity
-                max_article = article
-                max_article_summary = article_summary
+        article_summaries = await self._summarize_batch('articles about a topic', [
+            f"Title: {article['title']}. Snippet: {article['snippet']}. Description: {article['description']}."
+            for article in articles
+        ])
+        max_cosine_similarity, best = await self._get_max_cosine_similarity(presentation_summary, article_summaries)
+        max_article = articles[best] if best is not None else None
+        max_article_summary = article_summaries[best] if best is not None else ''
         return max_cosine_similarity, max_article, max_article_summary
 
 
+    async def _summarize_batch(self, description, documents):
+        """
+        Summarizes several documents with a single OpenAI request.
+
+        Args:
+            description (str): What the documents are, used in the prompt (e.g. 'articles about a topic').
+            documents (list): The documents to summarize.
+
+        Returns:
+            list: One summary per document, in the same order.
+        """
+        if not documents:
+            return []
+        numbered_documents = '\n\n'.join(
+            f'[{i}] {document[:MAX_BATCH_ITEM_CHARS]}' for i, document in enumerate(documents, start=1)
+        )
+        summaries = await self._make_openai_request(
+            f'Here are {len(documents)} numbered {description}. Please provide a summary of each in a couple sentences. '
+            f'Respond only with a JSON object of the form {{"summaries": ["summary of [1]", "summary of [2]", ...]}} '
+            f'containing exactly {len(documents)} summaries in the same order.\n\n{numbered_documents}',
+            parse=lambda response: self._parse_summaries(response, len(documents)),
+            response_format={'type': 'json_object'}
+        )
+        return summaries
+
+
+    def _parse_summaries(self, response, count):
+        # Raising on a malformed reply also keeps it out of the completion cache
+        summaries = json.loads(response)['summaries']
+        if not isinstance(summaries, list) or len(summaries) != count:
+            raise ValueError(f'Expected {count} summaries but received {summaries!r:.200}')
+        return summaries
+
+
     def parse_github_repo_url(self, repo_url):
         """
         Parses a GitHub repository URL and extracts the owner and repository name.
@@ -112,32 +192,25 @@ class NoveltyEvaluator:
         Returns:
             tuple: A tuple containing the owner and repository name (owner, repo_name).
         """
-        parsed_url = urlparse(repo_url)
-        
-        # Split the path to get the parts after 'github.com'
-        path_parts = parsed_url.path.strip('/').split('/')
-        
-        if len(path_parts) >= 2:
-            owner = path_parts[0]
-            repo_name = path_parts[1]
-            return owner, repo_name
-        else:
-            raise ValueError("Invalid GitHub repository URL format")
+        return _parse_owner_repo(repo_url)
 
 
-    def _fetch_google_results(self, query):
+    @retry_transient
+    async def _fetch_google_results(self, query):
         # SerpAPI endpoint URL
         url = 'https://www.searchapi.io/api/v1/search'
-        params = json.dumps({
+        params = {
             'q': query,  # Search query
             'hl': 'en',  # English
             'gl': 'us',  # Only US results
             'api_key': os.getenv('SERP_API_KEY'),  # API key
             'num': 10  # Number of results to fetch
-        })
+        }
 
-        response = requests.get(url=url, params=params)
+        response = await http_client.get(url, params=params)
 
+        if response.status_code in RETRYABLE_STATUS_CODES:
+            response.raise_for_status()
         if response.status_code == 200:
             return response.json()
         else:
@@ -160,7 +233,7 @@ class NoveltyEvaluator:
             return []
 
 
-    def _search_github_repos(self, query, per_page=10):
+    async def _search_github_repos(self, query, per_page=10):
         url = 'https://api.github.com/search/repositories'
         params = {
             'q': query,          # Search query
@@ -170,7 +243,7 @@ class NoveltyEvaluator:
             'Accept': 'application/vnd.github.v3+json'
         }
 
-        response = requests.get(url, headers=headers, params=params)
+        response = await self._github_get(url, params=params, headers=headers)
         if response.status_code == 200:
             return response.json()['items']
         else:
@@ -178,87 +251,126 @@ class NoveltyEvaluator:
             return []
         
     
-    def _fetch_readme(self, url):
-        owner, repo_name = self.parse_github_repo_url(url)
+    async def _fetch_readme(self, url):
+        owner, repo_name = _parse_owner_repo(url)
         url = f'https://api.github.com/repos/{owner}/{repo_name}/readme'
         headers = {
             'Accept': 'application/vnd.github.v3.raw+json'
         }
-        response = requests.get(url, headers=headers)
+        response = await self._github_get(url, headers=headers)
         if response.status_code == 200:
             return response.text
         else:
             return None
+
+
+    @retry_transient
+    async def _github_get(self, url, params=None, headers=None):
+        """
+        Sends a conditional GET to the GitHub API, waiting for the rate limit window to reset
+        when it is nearly used up and raising on retryable failures.
+
+        Args:
+            url (str): The GitHub API URL.
+            params (dict): The query parameters.
+            headers (dict): The request headers.
+
+        Returns:
+            httpx.Response: The response.
+        """
+        resource = 'search' if '/search/' in url else 'core'
+        remaining, reset = _github_rate_limits.get(resource, (None, 0))
+        if remaining is not None and remaining <= RATE_LIMIT_THRESHOLD and reset > time.time():
+            await asyncio.sleep(min(reset - time.time(), MAX_RATE_LIMIT_WAIT))
+
+        response = await cached_get(http_client, url, params=params, headers=headers)
+        if 'X-RateLimit-Remaining' in response.headers:
+            _github_rate_limits[response.headers.get('X-RateLimit-Resource', resource)] = (
+                int(response.headers['X-RateLimit-Remaining']),
+                int(response.headers.get('X-RateLimit-Reset', 0))
+            )
+        # GitHub reports an exhausted rate limit as 403 with no remaining requests
+        rate_limited = response.status_code == 403 and response.headers.get('X-RateLimit-Remaining') == '0'
+        if response.status_code in RETRYABLE_STATUS_CODES or rate_limited:
+            response.raise_for_status()
+        return response
     
 
-    def _make_openai_request(self, prompt):
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+    async def _make_openai_request(self, prompt, system=None, model=SUMMARY_MODEL, parse=None, **options):
+        messages = [{'role': 'system', 'content': system}] if system else []
+        messages.append({'role': 'user', 'content': prompt})
         try:
-            response = openai.ChatCompletion.create(
-                model='gpt-4',
-                messages=[
-                    {'role': 'user', 'content': prompt}
-                ]
-            )
-            return response['choices'][0]['message']['content'].strip()
+            return await llm.complete(model, messages, parse=parse or str.strip, **options)
         except Exception as e:
             raise ValueError(f'OpenAI Error: {e}')
 
 
-    def _build_project_summary(self, presentation_file_path, audio):
+    async def _build_project_summary(self, presentation_file_path, audio):
         if audio:
-            presentation_transcription = self._transcribe_mp3(presentation_file_path)
+            presentation_transcription = await self._transcribe_mp3(presentation_file_path)
         else:
-            presentation_transcription = self._transcribe_mp4(presentation_file_path)
-        summary = self._make_openai_request(
+            presentation_transcription = await self._transcribe_mp4(presentation_file_path)
+        summary = await self._make_openai_request(
             f'Here is a transcription of a project presentation, {presentation_transcription}. Please provide a summary of the project in a couple sentences.'
         )
         return summary
 
 
-    def _get_cosine_similarity(self, str1, str2):
-        tfidf_vectorizer = TfidfVectorizer()
-        tfidf_matrix = tfidf_vectorizer.fit_transform([str1, str2])
-        return cosine_similarity(tfidf_matrix[0:1], tfidf_matrix)[0][1]
-
-
-    def _transcribe_mp4(self, file_path):
+    async def _get_max_cosine_similarity(self, text, candidates):
         """
-        Takes an MP4 file, extracts the audio, and transcribes it using OpenAI's Whisper API.
+        Finds the candidate most similar to a text using OpenAI embeddings, falling back to
+        hashed bag-of-words vectors if the embeddings request fails.
 
         Args:
-            file_path (str): The path to the MP4 file.
+            text (str): The text to compare against.
+            candidates (list): The candidate texts.
 
         Returns:
-            str: The transcribed text.
+            tuple: The highest cosine similarity and the index of that candidate, or (0, None)
+                if no candidate has a positive similarity.
         """
-        openai.api_key = os.getenv('OPENAI_API_KEY')
+        if not candidates:
+            return 0, None
         try:
-            audio_file_path = self._extract_audio_from_video(file_path)
-            transcription = self._transcribe_mp3(audio_file_path)
-            os.remove(audio_file_path)
-            return transcription
+            embeddings = await self._embed_batch([text] + candidates)
+            similarities = embeddings[1:] @ embeddings[0]
         except Exception as e:
-            return f"An error occurred: {str(e)}"
+            logging.error(f'Embedding error, falling back to bag-of-words: {e}')
+            similarities = self._get_hashed_similarities(text, candidates)
+        best = int(similarities.argmax())
+        if similarities[best] <= 0:
+            return 0, None
+        return float(similarities[best]), best
+
 
+    async def _embed_batch(self, texts):
+        # One request embeds every uncached text; rows are L2-normalized so a dot product is the cosine similarity
+        embeddings = np.array(await llm.embed('text-embedding-3-small', texts))
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
 
-    def _extract_audio_from_video(self, video_path):
+
+    def _get_hashed_similarities(self, text, candidates):
+        vectors = _VECTORIZER.transform([text] + candidates)
+        return (vectors[1:] @ vectors[0].T).toarray().ravel()
+
+
+    async def _transcribe_mp4(self, file_path):
         """
-        Extracts audio from an MP4 video file and saves it as an MP3 file.
+        Transcribes the audio of an MP4 file using OpenAI's Whisper API.
 
         Args:
-            video_path (str): The path to the MP4 file.
+            file_path (str): The path to the MP4 file.
 
         Returns:
-            str: The path to the extracted MP3 file.
+            str: The transcribed text.
         """
-        audio_file_path = video_path.replace('.mp4', '.mp3')
-        clip = VideoFileClip(video_path)
-        clip.audio.write_audiofile(audio_file_path)
-        return audio_file_path
+        try:
+            return await transcribe_recording(file_path)
+        except Exception as e:
+            return f"An error occurred: {str(e)}"
 
 
-    def _transcribe_mp3(self, audio_file_path):
+    async def _transcribe_mp3(self, audio_file_path):
         """
         Transcribes an audio file using OpenAI's Whisper API.
 
@@ -268,6 +380,4 @@ class NoveltyEvaluator:
         Returns:
             str: The transcribed text.
         """
-        with open(audio_file_path, 'rb') as audio_file:
-            response = openai.Audio.transcribe('whisper-1', audio_file)
-        return response['text']
+        return await transcribe_recording(audio_file_path)
@@ -1,6 +1,6 @@
+import asyncio
 from pydantic import BaseModel
-from typing import Optional
-import io
+from typing import Any, Coroutine, Dict, List, Optional
 from app.services.github_services import GithubCodeEvaluator
 from app.services.presentation_services import PresentationEvaluator
 from app.services.web_scraper import NoveltyEvaluator
@@ -10,49 +10,75 @@ class Startup(BaseModel):
     id: Optional[int] = None
     name: str
     github_url: str
-    presentation_video: bytes
-    presentation_pdf: bytes
+    presentation_video_path: str
+    presentation_pdf_path: str
     github_grade: Optional[float] = None
     presentation_grade: Optional[float] = None
     novelty_grade: Optional[float] = None
     github_description: Optional[str] = None
     presentation_description: Optional[str] = None
     novelty_description: Optional[str] = None
+    # Grade descriptions keyed by "github", "presentation" and "novelty", filled in by create_and_grade
+    descriptions: Dict[str, str] = {}
 
     @classmethod
     async def create_and_grade(cls, startup_data):
         startup = cls(**startup_data.dict())
         await startup.grade()
+        startup.descriptions = {
+            "github": startup.get_github_grade_description(),
+            "presentation": startup.get_presentation_grade_description(),
+            "novelty": startup.get_novelty_grade_description()
+        }
         return startup
 
     async def grade(self):
-        # Grade GitHub repository
+        # The three graders are independent, so they run concurrently
         github_evaluator = GithubCodeEvaluator()
-        github_result = json.loads(github_evaluator.evaluate_repository(self.github_url))
+        presentation_evaluator = PresentationEvaluator()
+        novelty_evaluator = NoveltyEvaluator()
+        github_json, presentation_json, novelty_result = await self._run_all([
+            github_evaluator.evaluate_repository(self.github_url),
+            presentation_evaluator.process_presentation(self.presentation_pdf_path, self.presentation_video_path),
+            novelty_evaluator.evaluate_novelty(
+                self.github_url,
+                False,  # Assuming presentation_video is an MP4 file
+                self.presentation_video_path
+            )
+        ])
+
+        # Grade GitHub repository
+        github_result = json.loads(github_json)
         self.github_grade = github_result['overall_score']
         self.github_description = github_result['summary']
 
         # Grade presentation
-        presentation_evaluator = PresentationEvaluator()
-        presentation_result = json.loads(presentation_evaluator.process_presentation(
-            self.presentation_pdf,
-            self.presentation_video
-        ))
+        presentation_result = json.loads(presentation_json)
         self.presentation_grade = (presentation_result['slides_evaluation']['score'] + 
                                    presentation_result['pitch_evaluation']['overall_score']) / 2
         self.presentation_description = presentation_result['pitch_evaluation']['summary']
 
         # Grade novelty
-        novelty_evaluator = NoveltyEvaluator()
-        novelty_result = novelty_evaluator.evaluate_novelty(
-            self.github_url,
-            False,  # Assuming presentation_video is an MP4 file
-            io.BytesIO(self.presentation_video)
-        )
         self.novelty_grade = novelty_result['overall_score']
         self.novelty_description = (f"GitHub Summary: {novelty_result['github_summary']}\n"
                                     f"Google Summary: {novelty_result['google_summary']}")
 
+    @staticmethod
+    async def _run_all(coroutines: List[Coroutine]) -> List[Any]:
+        # Like asyncio.gather, but the first failure cancels the other graders, so none of them
+        # keeps calling APIs on upload files the caller is about to delete
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in tasks:
+                if task in done and task.exception() is not None:
+                    raise task.exception()
+            return [task.result() for task in tasks]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
     def get_github_grade_description(self):
         return self.github_description or "GitHub repository has not been graded yet."
 